@@ -0,0 +1,86 @@
+'''
+Local stand-ins for the telescope schedule API and the RTI endpoint
+
+The API answers cmd=getInstrumentStatus with every instrument available.
+RTI accepts every request and counts them.
+
+Example use:
+python fake_services.py [--port 8480]
+'''
+
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+from urllib.parse import urlparse, parse_qs
+
+
+INSTRUMENTS = ['DEIMOS', 'KCWI', 'MOSFIRE', 'NIRES']
+
+
+def main():
+    parser = argparse.ArgumentParser(description='fake_services.py input parameters')
+    parser.add_argument('--port', type=int, default=8480, help='Port to listen on')
+    args = parser.parse_args()
+
+    server, api, rti = start(args.port, background=False)
+    print(f'Telescope API: {api}')
+    print(f'RTI: {rti}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+def start(port=0, background=True):
+    '''
+    Returns the server, the API prefix for the drp_manager config and the
+    RTI url for the pypeit_lev2 config. Port 0 picks a free port.
+    '''
+    server = ThreadingHTTPServer(('localhost', port), ServiceHandler)
+    server.daemon_threads = True
+    server.rti_count = 0
+    server.api_count = 0
+    server.lock = threading.Lock()
+
+    if background:
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+
+    port = server.server_address[1]
+    return server, f'http://localhost:{port}/api?', f'http://localhost:{port}/rti'
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+
+        if url.path == '/rti':
+            with self.server.lock:
+                self.server.rti_count += 1
+            self.send(200, 'OK')
+        elif url.path == '/api' and query.get('cmd') == ['getInstrumentStatus']:
+            with self.server.lock:
+                self.server.api_count += 1
+            status = {inst: {'Available': 1, 'Scheduled': 1}
+                      for inst in INSTRUMENTS}
+            self.send(200, json.dumps([status]))
+        else:
+            self.send(404, 'Unknown request')
+
+    def send(self, code, body):
+        body = body.encode('utf8')
+        self.send_response(code)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,339 @@
+'''
+Benchmark and load test for the DRP scripts, without telescope data
+
+Generates synthetic nights, puts stub DRPs on the PATH and starts local
+stand-ins for the telescope API and RTI, then reports:
+
+    makespan     backlog queue vs one night at a time, with core utilization
+    status       is_drp_running and the drp_status.py snapshot with a large
+                 process table
+    alerts       alert_RTI throughput and chk_available latency
+
+Example use:
+python run_benchmarks.py [makespan status alerts] [--nights 10] [--procs 4]
+    [--processes 1000] [--alerts 500] [--json results.json]
+'''
+
+import argparse
+from argparse import Namespace
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import io
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import psutil
+
+BENCH_DIR = os.path.dirname(os.path.realpath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, os.path.join(ROOT_DIR, 'pypeit_scripts'))
+
+import drp_manager
+import drp_status
+import pypeit_backlog
+import pypeit_lev2
+import fake_services
+import synthetic
+
+
+STUBS = ['run_pypeit', 'pypeit_ql_keck_deimos', 'start_kcwi_rti']
+
+
+def main():
+    args = parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='drp_bench_')
+    os.makedirs(workdir, exist_ok=True)
+    print(f'Working in {workdir}')
+
+    install_stubs(workdir)
+    server, api, rti = fake_services.start()
+
+    results = {}
+    try:
+        if 'makespan' in args.benchmarks:
+            results['makespan'] = bench_makespan(workdir, rti, args)
+        if 'status' in args.benchmarks:
+            results['status'] = bench_status(workdir, args)
+        if 'alerts' in args.benchmarks:
+            results['alerts'] = bench_alerts(workdir, server, api, rti, args)
+    finally:
+        server.shutdown()
+        if not args.keep and not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+def parse_args():
+
+    parser = argparse.ArgumentParser(description='run_benchmarks.py input parameters')
+
+    parser.add_argument('benchmarks', nargs='*',
+                        default=['makespan', 'status', 'alerts'],
+                        help='makespan, status, alerts. Defaults to all')
+    parser.add_argument('--procs', type=int, default=4,
+                        help='Pool size for the makespan benchmark')
+    parser.add_argument('--processes', type=int, default=1000,
+                        help='Extra processes in the table for the status benchmark')
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='Repetitions for the latency measurements')
+    parser.add_argument('--alerts', type=int, default=500,
+                        help='Number of RTI alerts to send')
+    parser.add_argument('--threads', type=int, default=8,
+                        help='Threads sending RTI alerts')
+    parser.add_argument('--workdir', type=str,
+                        help='Directory for the synthetic data, kept afterwards')
+    parser.add_argument('--keep', action='store_true',
+                        help='Keep the temporary working directory')
+    parser.add_argument('--json', type=str,
+                        help='Also write the results to this file')
+    synthetic.add_arguments(parser)
+
+    return parser.parse_args()
+
+
+def install_stubs(workdir):
+    '''
+    Puts wrappers for the stub DRPs first on the PATH
+    '''
+    bin_dir = os.path.join(workdir, 'bin')
+    os.makedirs(bin_dir, exist_ok=True)
+    stub = os.path.join(BENCH_DIR, 'stub_drp.py')
+
+    for name in STUBS:
+        path = os.path.join(bin_dir, name)
+        with open(path, 'w') as f:
+            f.write(f'#!/bin/sh\nexec "{sys.executable}" "{stub}" {name} "$@"\n')
+        os.chmod(path, 0o755)
+
+    os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+    os.environ['BENCH_LOG'] = os.path.join(workdir, 'jobs.log')
+
+
+def get_cfg(workdir, rti):
+    '''
+    Writes and reads a pypeit_lev2 config pointing at the synthetic data
+    '''
+    cfg_file = os.path.join(workdir, 'pypeit_lev2.bench.ini')
+    with open(cfg_file, 'w') as f:
+        f.write(f'''[INSTRUMENTS]
+keck_inst_names = DEIMOS
+pypeit_inst_names = keck_deimos
+roots = DE.
+ir_insts = MOSFIRE NIRES
+
+[RTI]
+user = bench
+pass = bench
+url = {rti}
+rti_ingesttype = lev2
+rti_reingest = False
+rti_testonly = True
+rti_dev = True
+
+[BACKLOG]
+input_dir = {workdir}/koa/INSTRUMENT/UTDATE/lev0
+output_dir = {workdir}/drp/INSTRUMENT_DRP/UTDATE
+state_dir = {workdir}/state
+poll = 0.05
+''')
+
+    return pypeit_lev2.get_config(cfg_file)
+
+
+###
+##### Makespan
+###
+
+
+def bench_makespan(workdir, rti, args):
+    '''
+    Reduces the synthetic nights with the backlog queue and one night at a
+    time, as repeated pypeit_lev2.py runs would
+    '''
+    nights = synthetic.make_nights(workdir, args)
+    cfg = get_cfg(workdir, rti)
+    durations = [d for night in nights for _, d in night['configs']]
+
+    pargs = Namespace(insts=['DEIMOS'], start=nights[0]['utdate'],
+                      end=nights[-1]['utdate'], keys=None, frametype=None,
+                      calib=False, setup=False, num_proc=args.procs)
+    backlog_nights = pypeit_backlog.get_nights(pargs, cfg)
+
+    results = {
+        'nights': len(nights),
+        'jobs': len(durations),
+        'procs': args.procs,
+        'work': round(sum(durations), 2),
+        'lower_bound': round(max(sum(durations) / args.procs, max(durations)), 2)
+    }
+
+    def run(name, groups):
+        log = os.environ['BENCH_LOG']
+        if os.path.exists(log):
+            os.remove(log)
+
+        start = time.time()
+        for i, group in enumerate(groups):
+            pargs.state_dir = os.path.join(workdir, 'state', f'{name}_{i}')
+            os.makedirs(pargs.state_dir, exist_ok=True)
+            # Setup is done by synthetic.py
+            pypeit_backlog.save_state(
+                os.path.join(pargs.state_dir, 'state.json'),
+                {f'{n.inst}/{n.utdate}': 'done' for n in group})
+            with quiet():
+                pypeit_backlog.run_backlog(group, pargs, cfg)
+        makespan = time.time() - start
+
+        busy = 0
+        with open(log) as f:
+            for line in f:
+                _, job_start, job_end = line.split()
+                busy += float(job_end) - float(job_start)
+
+        results[name] = {
+            'makespan': round(makespan, 2),
+            'utilization': round(busy / (makespan * args.procs), 3)
+        }
+
+    run('backlog', [backlog_nights])
+    run('per_night', [[night] for night in backlog_nights])
+
+    return results
+
+
+###
+##### Status
+###
+
+
+def bench_status(workdir, args):
+    '''
+    Times the process scans with a large process table and a running DRP
+    '''
+    os.environ['BENCH_DURATION'] = '-1'
+    drp = subprocess.Popen(['start_kcwi_rti', '-d', f'{workdir}/koa/KCWI/20240101/lev0'],
+                           start_new_session=True)
+    os.environ['BENCH_DURATION'] = '1'
+
+    sleepers = [subprocess.Popen(['sleep', '600']) for _ in range(args.processes)]
+
+    config = {'KCWI': {'ACCOUNT': '', 'DRP': 'start_kcwi_rti',
+                       'EXTRAS': ['geckodriver', 'FirefoxApp', 'bokeh']}}
+
+    try:
+        def manager():
+            with quiet():
+                pid = drp_manager.is_drp_running('start_kcwi_rti',
+                                                 config['KCWI']['EXTRAS'],
+                                                 '20240101')
+            assert pid, 'stub DRP not found'
+
+        def snapshot():
+            status = drp_status.take_snapshot(config, {})
+            assert status['drps']['KCWI']['state'] == 'running'
+
+        results = {
+            'processes': len(psutil.pids()),
+            'is_drp_running': latency(manager, args.repeat),
+            'snapshot': latency(snapshot, args.repeat)
+        }
+
+        # Stopping the stub measures the stop latency as well
+        with quiet():
+            pid = drp_manager.is_drp_running('start_kcwi_rti', [], '20240101')
+            start = time.time()
+            left = drp_manager.process_stop(pid, 'start_kcwi_rti', grace=5)
+        assert pid and left == [], 'stub DRP did not stop'
+        results['process_stop'] = {'ms': round((time.time() - start) * 1000, 1)}
+
+    finally:
+        for p in sleepers + [drp]:
+            p.kill()
+        for p in sleepers + [drp]:
+            p.wait()
+
+    return results
+
+
+###
+##### Alerts
+###
+
+
+def bench_alerts(workdir, server, api, rti, args):
+    '''
+    Sends RTI alerts from several threads and times the schedule check
+    '''
+    cfg = get_cfg(workdir, rti)
+    pargs = Namespace(inst='DEIMOS')
+    server.rti_count = 0
+
+    start = time.time()
+    with quiet(), ThreadPoolExecutor(max_workers=args.threads) as executor:
+        list(executor.map(
+            lambda i: pypeit_lev2.alert_RTI(f'{workdir}/drp/{i}', pargs, cfg),
+            range(args.alerts)))
+    elapsed = time.time() - start
+
+    config = {'API': {'TEL': api}}
+
+    def schedule():
+        with quiet():
+            assert drp_manager.chk_available('20240102', config, 'DEIMOS')
+
+    return {
+        'sent': args.alerts,
+        'received': server.rti_count,
+        'per_second': round(server.rti_count / elapsed, 1),
+        'chk_available': latency(schedule, args.repeat)
+    }
+
+
+###
+##### Helpers
+###
+
+
+def latency(func, repeat):
+    '''
+    Returns the median and 95th percentile time of func in milliseconds
+    '''
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append((time.perf_counter() - start) * 1000)
+    times.sort()
+
+    return {
+        'median_ms': round(statistics.median(times), 2),
+        'p95_ms': round(times[min(len(times) - 1, int(0.95 * len(times)))], 2)
+    }
+
+
+@contextlib.contextmanager
+def quiet():
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+
+def print_results(results):
+    for name, result in results.items():
+        print(f'\n{name}')
+        for key, value in result.items():
+            print(f'    {key:16} {value}')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+'''
+Stand-in for the DRP programs, used by run_benchmarks.py
+
+run_benchmarks.py puts wrappers named run_pypeit, pypeit_ql_keck_deimos and
+start_kcwi_rti on the PATH that call this script with their own name as the
+first argument. The stub keeps one core busy and holds memory for a while,
+then exits like the real program would.
+
+run_pypeit takes its duration, memory and output size from the
+"# bench:" line that synthetic.py writes into each .pypeit file. The other
+stubs use the BENCH_DURATION (seconds, -1 runs until killed), BENCH_MEMORY
+(MB) and BENCH_OUTPUT (MB) environment variables.
+
+Every finished job appends "name start end" to the file in BENCH_LOG.
+'''
+
+import os
+import sys
+import time
+
+
+def main():
+    name = sys.argv[1]
+    args = sys.argv[2:]
+
+    duration = float(os.environ.get('BENCH_DURATION', 1))
+    memory = int(os.environ.get('BENCH_MEMORY', 0))
+    output_mb = int(os.environ.get('BENCH_OUTPUT', 0))
+    output_dir = None
+
+    if name == 'run_pypeit':
+        with open(args[0]) as f:
+            for line in f:
+                if line.startswith('# bench:'):
+                    pars = dict(p.split('=') for p in line.split(':')[1].split())
+                    duration = float(pars.get('duration', duration))
+                    memory = int(pars.get('memory', memory))
+                    output_mb = int(pars.get('output', output_mb))
+        if '-r' in args:
+            output_dir = args[args.index('-r') + 1]
+
+    start = time.time()
+
+    # Touch every page so the memory is really resident
+    block = bytearray(memory * 1024 * 1024)
+    for i in range(0, len(block), 4096):
+        block[i] = 1
+
+    # Busy loop, the real reductions are CPU bound
+    while duration < 0 or time.time() - start < duration:
+        sum(range(10000))
+
+    if output_dir and output_mb:
+        science = os.path.join(output_dir, 'Science')
+        os.makedirs(science, exist_ok=True)
+        with open(os.path.join(science, 'spec2d_bench.fits'), 'wb') as f:
+            f.write(os.urandom(output_mb * 1024 * 1024 // 2))
+            f.write(bytes(output_mb * 1024 * 1024 // 2))
+
+    log = os.environ.get('BENCH_LOG')
+    if log:
+        with open(log, 'a') as f:
+            f.write(f'{name} {start} {time.time()}\n')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+'''
+Synthetic nights for run_benchmarks.py
+
+Writes lev0 directories of small FITS files and, for each configuration, the
+.pypeit file that the setup step would have produced. Each .pypeit file
+carries a "# bench:" line telling stub_drp.py how long to run, how much
+memory to hold and how much output to write.
+
+Example use:
+python synthetic.py /tmp/bench --nights 10 --configs 2-8 --duration 0.5-3
+'''
+
+import argparse
+from datetime import datetime, timedelta
+import os
+import random
+import string
+
+
+def main():
+    parser = argparse.ArgumentParser(description='synthetic.py input parameters')
+    parser.add_argument('workdir', help='Directory to write the nights to')
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    nights = make_nights(args.workdir, args)
+    jobs = sum(len(night['configs']) for night in nights)
+    print(f'Wrote {len(nights)} nights with {jobs} configurations to {args.workdir}')
+
+
+def add_arguments(parser):
+    parser.add_argument('--nights', type=int, default=10,
+                        help='Number of nights')
+    parser.add_argument('--configs', type=span, default=(2, 8),
+                        help='Configurations per night, min-max')
+    parser.add_argument('--duration', type=span, default=(0.5, 3),
+                        help='Seconds per reduction, min-max')
+    parser.add_argument('--memory', type=int, default=50,
+                        help='MB held by each reduction')
+    parser.add_argument('--output', type=int, default=0,
+                        help='MB of products written by each reduction')
+    parser.add_argument('--frames', type=int, default=5,
+                        help='lev0 frames per configuration')
+    parser.add_argument('--seed', type=int, default=1,
+                        help='Random seed, the same seed gives the same nights')
+
+
+def span(s):
+    '''
+    Parses "min-max" or a single value into a (min, max) tuple
+    '''
+    low, _, high = s.partition('-')
+    try:
+        return float(low), float(high or low)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Not a range: '{s}'")
+
+
+def make_nights(workdir, args, inst='DEIMOS', pypeit_name='keck_deimos',
+                root='DE.', start='20240101'):
+    '''
+    Writes the nights and returns a list of
+    {'utdate', 'lev0', 'output', 'configs': [(pypeit_file, duration)]}
+    '''
+    rng = random.Random(args.seed)
+    day = datetime.strptime(start, '%Y%m%d')
+
+    nights = []
+    for n in range(args.nights):
+        utdate = (day + timedelta(days=n)).strftime('%Y%m%d')
+        lev0 = os.path.join(workdir, 'koa', inst, utdate, 'lev0')
+        output = os.path.join(workdir, 'drp', f'{inst}_DRP', utdate)
+        setup_dir = os.path.join(output, 'pypeit_files')
+        os.makedirs(lev0, exist_ok=True)
+        os.makedirs(setup_dir, exist_ok=True)
+
+        count = rng.randint(int(args.configs[0]), int(args.configs[1]))
+        configs = []
+        for c in range(min(count, 26)):
+            setup = string.ascii_uppercase[c]
+            duration = round(rng.uniform(*args.duration), 2)
+
+            files = []
+            for i in range(args.frames):
+                frame = f'{root}{utdate}.{c * args.frames + i:05d}.fits'
+                write_fits(os.path.join(lev0, frame), {
+                    'INSTRUME': inst,
+                    'KOAIMTYP': 'object' if i else 'flatlamp',
+                    'ELAPTIME': 60.0,
+                    'GRATENAM': f'G{setup}'
+                }, size=rng.randint(10, 200))
+                files.append(frame)
+
+            pypeit_file = os.path.join(setup_dir, f'{pypeit_name}_{setup}.pypeit')
+            write_pypeit(pypeit_file, pypeit_name, lev0, files, setup,
+                         duration, args.memory, args.output)
+            configs.append((pypeit_file, duration))
+
+        nights.append({'utdate': utdate, 'lev0': lev0, 'output': output,
+                       'configs': configs})
+
+    return nights
+
+
+def write_fits(path, cards, size):
+    '''
+    Writes a FITS file with the given header cards and a size x size
+    16 bit image
+    '''
+    header = [f'{"SIMPLE":8}= {"T":>20}', f'{"BITPIX":8}= {16:>20}',
+              f'{"NAXIS":8}= {2:>20}', f'{"NAXIS1":8}= {size:>20}',
+              f'{"NAXIS2":8}= {size:>20}']
+    for key, value in cards.items():
+        if isinstance(value, str):
+            value = f"'{value:8}'"
+        header.append(f'{key:8}= {value:>20}')
+    header.append('END')
+
+    header = ''.join(card.ljust(80) for card in header)
+    header += ' ' * (-len(header) % 2880)
+    data = 2 * size * size
+
+    with open(path, 'wb') as f:
+        f.write(header.encode('ascii'))
+        f.write(bytes(data + (-data % 2880)))
+
+
+def write_pypeit(path, pypeit_name, lev0, files, setup, duration, memory,
+                 output):
+    lines = [
+        f'# bench: duration={duration} memory={memory} output={output}',
+        '',
+        '# User-defined execution parameters',
+        '[rdx]',
+        f'    spectrograph = {pypeit_name}',
+        '',
+        '# Setup',
+        'setup read',
+        f'Setup {setup}:',
+        'setup end',
+        '',
+        '# Data block',
+        'data read',
+        f' path {lev0}',
+        '|    filename |    frametype |',
+    ]
+    for i, frame in enumerate(files):
+        frametype = 'science' if i else 'pixelflat,trace'
+        lines.append(f'| {frame} | {frametype} |')
+    lines.append('data end')
+
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+if __name__ == "__main__":
+    main()
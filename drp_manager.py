@@ -5,22 +5,33 @@ NOTE: Script is currently designed to assume this file exists
 in same directory as python module it wil start.
 
 Example use:
-python lev2_manager.py instrument start|stop|restart|status [--utdate yyyymmdd] [--skip_avail]
+python lev2_manager.py instrument start|stop|restart|status [--utdate yyyymmdd] [--skip_avail] [--grace seconds]
     --skip_avail will skip the instrument availability check and start DRP
+    --grace is how long stop waits for the DRP to exit before killing it
+
+yaml, psutil, urllib and subprocess are imported only by the commands that
+need them, and the parsed config is cached next to the source, so status
+and stop start quickly.
 '''
 
 import argparse
-import yaml
 from datetime import datetime, timedelta
-from urllib.request import urlopen
 import json
 from pathlib import Path
 import os
 import sys
-import subprocess
-import psutil
+import signal
+import time
 import getpass
 
+# Seconds to wait for a DRP to exit after SIGTERM, then after SIGKILL
+STOP_GRACE = 10
+KILL_WAIT = 5
+
+CONFIG_FILE = 'drp_config.live.ini'
+# Keys every DRP section of the config needs
+DRP_KEYS = ['ACCOUNT', 'DRP', 'DRPDIR']
+
 
 def main():
     args = parse_args()
@@ -37,31 +48,42 @@ def main():
     os.chdir(dir)
 
     # Read configuration file and verify
-    with open('drp_config.live.ini') as f: config = yaml.safe_load(f)
+    config = load_config(CONFIG_FILE)
     verify_inputs(config, inst)
 
-    koa_dir, drp_dir = get_dirs(config, inst, utdate, args.level)
-
-    # PypeIt?
-    pypeit = False
-    if inst in config['PYPEIT']:
-        pypeit = True
-
     # DRP name and command
     drp = config[inst]['DRP']
-    drp_cmd, extras = get_cmd(config, inst, utdate, koa_dir, args.level)
+    extras = config[inst].get('EXTRAS', [])
+
+    # Only starting needs the directories and command, status and stop
+    # should not touch the filesystem
+    if command in ['start', 'restart']:
+        koa_dir, drp_dir = get_dirs(config, inst, utdate, args.level)
+
+        # PypeIt?
+        pypeit = False
+        if inst in config['PYPEIT']:
+            pypeit = True
+
+        drp_cmd, extras = get_cmd(config, inst, utdate, koa_dir, args.level)
+
+    grace = args.grace
+    if grace is None:
+        grace = config[inst].get('STOP_GRACE', STOP_GRACE)
 
     # Do the request
     pid = is_drp_running(drp, extras, utdate)
     if command == 'stop':
-        pid = process_stop(pid)
+        pid = process_stop(pid, drp, grace)
     elif command == 'start':
         if skip_avail or chk_available(utdate, config, inst):
             process_start(pid, drp, drp_dir, drp_cmd, pypeit)
             pid = is_drp_running(drp, extras, utdate)
     elif command == 'restart':
-        pid = process_stop(pid)
+        # process_start refuses to start if anything survived the stop
+        pid = process_stop(pid, drp, grace)
         process_start(pid, drp, drp_dir, drp_cmd, pypeit)
+        pid = is_drp_running(drp, extras, utdate)
 
     exit(0) if len(pid) > 0 else exit(1)
 
@@ -82,6 +104,8 @@ def parse_args():
                         help='UT date for DRP process (yyyymmdd)')
     parser.add_argument('--skip_avail', action='store_true',
                         help='Override schedule check')
+    parser.add_argument('--grace', type=float,
+                        help='Seconds to wait for the DRP to stop before killing it')
 
     return parser.parse_args()
 
@@ -90,9 +114,10 @@ def is_drp_running(drp, extras, utdate):
     '''
     Returns PID if DRP is currently running, else 0
     '''
-    matches = []
+    import psutil
+
     current_user = getpass.getuser()
-    list1 = [drp, utdate]
+    pinfos = []
 
     for proc in psutil.process_iter():
         pinfo = proc.as_dict(attrs=['name', 'username', 'pid', 'cmdline'])
@@ -100,6 +125,33 @@ def is_drp_running(drp, extras, utdate):
         if pinfo['username'] != current_user:
             continue
 
+        pinfos.append(pinfo)
+
+    matches = find_drp_procs(pinfos, drp, extras, utdate)
+
+    if len(matches) == 0:
+        print("WARN: NO MATCHING PROCESSES FOUND")
+        return []
+    elif len(matches) > 1:
+        print(f"WARN: MULTIPLE MATCHES: \n {matches}")
+    else:
+        print(f"FOUND PROCESS: {matches[0]}")
+
+    return matches
+
+
+def find_drp_procs(pinfos, drp, extras, utdate=None):
+    '''
+    Returns the process info dicts belonging to the DRP and its extras.
+    Any UT date matches if utdate is None.
+    '''
+    matches = []
+    list1 = [drp] if utdate is None else [drp, utdate]
+
+    for pinfo in pinfos:
+        if not pinfo['cmdline']:
+            continue
+
         found = 0
         for name in list1:
             for cmd in pinfo['cmdline']:
@@ -115,19 +167,13 @@ def is_drp_running(drp, extras, utdate):
                     matches.append(pinfo)
                     continue
 
-    if len(matches) == 0:
-        print("WARN: NO MATCHING PROCESSES FOUND")
-        return []
-    elif len(matches) > 1:
-        print(f"WARN: MULTIPLE MATCHES: \n {matches}")
-    else:
-        print(f"FOUND PROCESS: {matches[0]}")
-
     return matches
 
 
 def chk_available(utdate, config, inst):
     # Verify instrument is available or scheduled
+    from urllib.request import urlopen
+
     hst = datetime.strptime(utdate, '%Y%m%d') - timedelta(days=1)
     hstDate = hst.strftime('%Y-%m-%d')
     api = f"{config['API']['TEL']}cmd=getInstrumentStatus&date={hstDate}"
@@ -148,9 +194,11 @@ def process_start(pid, drp, drp_dir, drp_cmd, pypeit):
     Start the requested DRP
     '''
     if len(pid) > 0:
-        print('{drp} already running with PID: {pid}')
+        print(f'{drp} already running with PID: {pid}')
         return
 
+    import subprocess
+
     # start the DRP
     cmd = []
     for word in drp_cmd.split(' '):
@@ -158,30 +206,194 @@ def process_start(pid, drp, drp_dir, drp_cmd, pypeit):
 
     print(f'Starting "{drp}" with the cmd:' + str(cmd))
     try:
-        # change to output directory and start DRP
+        # change to output directory and start DRP in its own process
+        # group, so stop can find all of its children
         if pypeit == False:
             os.chdir(drp_dir)
-        p = subprocess.Popen(cmd)
+        p = subprocess.Popen(cmd, start_new_session=True)
     except Exception as e:
         print('Error running command: ' + str(e))
     print('Done')
 
 
-def process_stop(pid):
+def process_stop(pid, drp, grace=STOP_GRACE):
     '''
-    Use psutil to kill the process ID
+    Use psutil to stop the process IDs, their children and the process
+    groups led by the DRP itself. This process and its parents are never
+    touched, even if their command line matched. Sends SIGTERM, waits up
+    to grace seconds, then SIGKILLs anything left. Takes at most
+    grace + KILL_WAIT seconds. Returns pid unchanged if anything survived,
+    else an empty list.
     '''
+    import psutil
 
     if len(pid) == 0:
         print('Process is not running')
-    else:
-        for entry in pid:
-            print('Killing PID', entry['pid'])
+        return pid
+
+    me = psutil.Process()
+    protected = set([me.pid] + [p.pid for p in me.parents()])
+    my_group = os.getpgid(0)
+
+    # Collect the whole tree before signalling, children get reparented
+    procs = {}
+    groups = set()
+    for entry in pid:
+        if entry['pid'] in protected:
+            print('Not killing PID', entry['pid'], '(this process or a parent)')
+            continue
+        try:
             p = psutil.Process(entry['pid'])
+            procs[p.pid] = p
+            for child in p.children(recursive=True):
+                if child.pid not in protected:
+                    procs[child.pid] = child
+            # Only the DRP was started as a group leader by process_start
+            is_drp = any(drp in cmd for cmd in entry['cmdline'] or [])
+            pgid = os.getpgid(p.pid)
+            if is_drp and pgid == p.pid and pgid != my_group:
+                groups.add(pgid)
+        except (psutil.NoSuchProcess, ProcessLookupError):
+            continue
+
+    for p in procs.values():
+        print('Killing PID', p.pid)
+        try:
             p.terminate()
-        pid = []
+        except psutil.NoSuchProcess:
+            pass
+    signal_groups(groups, signal.SIGTERM)
+
+    # One deadline for the processes and the groups together
+    deadline = time.monotonic() + grace
+    gone, alive = psutil.wait_procs(procs.values(), timeout=grace)
+    alive = [p for p in alive if not is_zombie(p)]
+    groups = wait_groups(groups, deadline - time.monotonic())
+
+    if alive or groups:
+        for p in alive:
+            print('PID', p.pid, f'still running after {grace}s, sending SIGKILL')
+            try:
+                p.kill()
+            except psutil.NoSuchProcess:
+                pass
+        signal_groups(groups, signal.SIGKILL)
+        deadline = time.monotonic() + KILL_WAIT
+        gone, alive = psutil.wait_procs(alive, timeout=KILL_WAIT)
+        alive = [p for p in alive if not is_zombie(p)]
+        groups = wait_groups(groups, deadline - time.monotonic())
+
+    if alive or groups:
+        print(f'ERROR: processes still running: {[p.pid for p in alive]}, '
+              f'groups: {sorted(groups)}')
+        return pid
+
+    return []
+
+
+def is_zombie(p):
+    '''
+    True if the process has exited and only waits to be reaped
+    '''
+    import psutil
+
+    try:
+        return p.status() == psutil.STATUS_ZOMBIE
+    except psutil.NoSuchProcess:
+        return True
+
+
+def signal_groups(groups, sig):
+    '''
+    Send sig to every process group in groups
+    '''
+    for pgid in groups:
+        try:
+            os.killpg(pgid, sig)
+        except (ProcessLookupError, PermissionError):
+            pass
 
-    return pid
+
+def wait_groups(groups, timeout):
+    '''
+    Wait up to timeout seconds for the process groups to empty. Returns the
+    groups that still have members.
+    '''
+    deadline = time.monotonic() + timeout
+    alive = set(groups)
+    while alive:
+        for pgid in list(alive):
+            try:
+                os.killpg(pgid, 0)
+            except ProcessLookupError:
+                alive.discard(pgid)
+            except PermissionError:
+                pass
+        if not alive or time.monotonic() >= deadline:
+            break
+        time.sleep(0.1)
+
+    return alive
+
+
+def load_config(config_file):
+    '''
+    Returns the parsed config. The YAML is parsed and validated only when
+    the file changed since the last run, otherwise the JSON cache written
+    next to it is used.
+    '''
+    stat = os.stat(config_file)
+    source = [stat.st_mtime_ns, stat.st_size]
+    cache_file = f'{config_file}.cache.json'
+
+    try:
+        with open(cache_file) as f:
+            cache = json.load(f)
+        if cache['source'] == source:
+            return cache['config']
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    import yaml
+
+    with open(config_file) as f: config = yaml.safe_load(f)
+    validate_config(config)
+
+    # Not being able to write the cache only costs speed, e.g. when the
+    # YAML holds values JSON can't, like unquoted dates. Only cache what
+    # JSON gives back unchanged, integer keys would come back as strings.
+    tmp = f'{cache_file}.{os.getpid()}'
+    try:
+        data = json.dumps({'source': source, 'config': config})
+        if json.loads(data)['config'] != config:
+            return config
+        with open(tmp, 'w') as f:
+            f.write(data)
+        os.replace(tmp, cache_file)
+    except (OSError, TypeError, ValueError):
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+
+    return config
+
+
+def validate_config(config):
+    '''
+    Exits if a DRP section of the config is missing a required key
+    '''
+    if not isinstance(config, dict):
+        sys.exit('Invalid config')
+
+    for inst, inst_config in config.items():
+        if not isinstance(inst_config, dict) or 'DRP' not in inst_config:
+            continue
+        for key in DRP_KEYS:
+            if key not in inst_config:
+                sys.exit(f'Invalid config: {inst} has no {key}')
+
+    return True
 
 
 def verify_inputs(config, inst):
@@ -0,0 +1,206 @@
+'''
+Local status service for every DRP managed by drp_manager.py
+
+Keeps an in-memory snapshot of all DRPs in the config, refreshed with a
+single process scan every INTERVAL seconds, and serves it as JSON so
+monitoring does not need to run drp_manager.py status for each instrument.
+
+Example use:
+python drp_status.py [--port 8470] [--interval 5]
+curl http://localhost:8470/status
+curl http://localhost:8470/status/DEIMOS
+'''
+
+import argparse
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import re
+import threading
+import time
+import psutil
+
+from drp_manager import CONFIG_FILE, find_drp_procs, load_config
+
+
+ATTRS = ['name', 'username', 'pid', 'cmdline', 'create_time',
+         'cpu_percent', 'memory_info']
+
+
+def main():
+    args = parse_args()
+
+    # Go to the directory of the source
+    dir = os.path.dirname(os.path.realpath(__file__))
+    os.chdir(dir)
+
+    config = load_config(args.config)
+
+    status = config.get('STATUS', {})
+    host = args.host or status.get('HOST', 'localhost')
+    port = args.port or int(status.get('PORT', 8470))
+    interval = args.interval or float(status.get('INTERVAL', 5))
+
+    server = ThreadingHTTPServer((host, port), StatusHandler)
+    server.snapshot = take_snapshot(config, {})
+
+    refresh = threading.Thread(target=refresh_loop,
+                               args=(server, config, interval), daemon=True)
+    refresh.start()
+
+    print(f'Serving DRP status on http://{host}:{port}/status')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+def parse_args():
+
+    parser = argparse.ArgumentParser(description='drp_status.py input parameters')
+
+    parser.add_argument('--config', type=str, default=CONFIG_FILE,
+                        help='drp_manager config file')
+    parser.add_argument('--host', type=str,
+                        help='Address to listen on, defaults to the config')
+    parser.add_argument('--port', type=int,
+                        help='Port to listen on, defaults to the config')
+    parser.add_argument('--interval', type=float,
+                        help='Seconds between refreshes, defaults to the config')
+
+    return parser.parse_args()
+
+
+def refresh_loop(server, config, interval):
+    '''
+    Replaces the server snapshot every interval seconds
+    '''
+    while True:
+        time.sleep(interval)
+        try:
+            server.snapshot = take_snapshot(config, server.snapshot['drps'])
+        except Exception as e:
+            print(f'Error refreshing status: {e}')
+
+
+def take_snapshot(config, previous):
+    '''
+    Returns the status of every DRP in the config from a single scan of the
+    process table. previous is the 'drps' entry of the last snapshot, used
+    to remember when a DRP stopped.
+    '''
+    now = time.time()
+
+    pinfos = []
+    for proc in psutil.process_iter(attrs=ATTRS, ad_value=None):
+        pinfos.append(proc.info)
+
+    drps = {}
+    for inst, inst_config in config.items():
+        if not isinstance(inst_config, dict) or 'DRP' not in inst_config:
+            continue
+
+        account = inst_config.get('ACCOUNT')
+        owned = [p for p in pinfos if not account or p['username'] == account]
+        extras = inst_config.get('EXTRAS', [])
+        procs = find_drp_procs(owned, inst_config['DRP'], extras)
+
+        drps[inst] = drp_status(inst_config, procs, previous.get(inst), now)
+
+    return {
+        'time': datetime.utcnow().isoformat(),
+        'drps': drps
+    }
+
+
+def drp_status(inst_config, procs, previous, now):
+    '''
+    Returns the status of one DRP from its matched processes
+    '''
+    drp = inst_config['DRP']
+    procs = list({p['pid']: p for p in procs}.values())
+    primary = [p for p in procs if any(drp in cmd for cmd in p['cmdline'])]
+
+    status = {
+        'state': 'stopped',
+        'pid': None,
+        'pids': sorted(set(p['pid'] for p in procs)),
+        'uptime': None,
+        'cpu_percent': sum(p['cpu_percent'] or 0 for p in procs),
+        'rss': sum(p['memory_info'].rss for p in procs if p['memory_info']),
+        'utdate': None,
+        'stopped_at': None,
+        'last_exit_code': None,
+        'queue_depth': None
+    }
+
+    if primary:
+        first = min(primary, key=lambda p: p['create_time'] or now)
+        status['state'] = 'running'
+        status['pid'] = first['pid']
+        if first['create_time']:
+            status['uptime'] = round(now - first['create_time'], 1)
+        match = re.search(r'(?:^|\D)(\d{8})(?:\D|$)', ' '.join(first['cmdline']))
+        if match:
+            status['utdate'] = match.group(1)
+    elif previous is not None:
+        # Remember when it stopped and what it was doing
+        status['utdate'] = previous['utdate']
+        status['stopped_at'] = previous['stopped_at']
+        if previous['state'] == 'running':
+            status['stopped_at'] = datetime.utcnow().isoformat()
+
+    # Queue progress written by the DRP itself, e.g. pypeit_lev2.py. UTDATE
+    # is replaced by the night the DRP is or was reducing.
+    status_file = inst_config.get('STATUS_FILE')
+    if status_file and 'UTDATE' in status_file:
+        if status['utdate']:
+            status_file = status_file.replace('UTDATE', status['utdate'])
+        else:
+            status_file = None
+    if status_file:
+        try:
+            with open(status_file) as f:
+                progress = json.load(f)
+            status['queue_depth'] = progress.get('queue_depth')
+            status['last_exit_code'] = progress.get('last_exit_code')
+        except (OSError, ValueError):
+            pass
+
+    return status
+
+
+class StatusHandler(BaseHTTPRequestHandler):
+    '''
+    Serves the current snapshot: /status for all DRPs, /status/<inst> for one
+    '''
+
+    def do_GET(self):
+        snapshot = self.server.snapshot
+        parts = [p for p in self.path.split('?')[0].split('/') if p]
+
+        if parts == ['status']:
+            self.send_json(200, snapshot)
+        elif len(parts) == 2 and parts[0] == 'status' \
+                and parts[1].upper() in snapshot['drps']:
+            self.send_json(200, snapshot['drps'][parts[1].upper()])
+        else:
+            self.send_json(404, {'error': f'Unknown path {self.path}'})
+
+    def send_json(self, code, data):
+        body = json.dumps(data).encode('utf8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Dashboards poll every few seconds, don't log each request
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,410 @@
+"""SQLite index of lev0 frames.
+
+The scanner lists each lev0 directory and only re-reads headers of files
+whose size or mtime changed since the last scan, so a rescan costs a stat per
+file rather than a header read.  A directory is read again in full when the
+file root or header keys in the config change.  Use --full to force a
+complete rescan.
+
+Example use:
+python lev0_index.py scan DEIMOS [-s 20240201 -e 20240731] [--full]
+python lev0_index.py nights DEIMOS -s 20240201 -e 20240731 --key GRATENAM=900ZD
+python lev0_index.py frames DEIMOS 20240203 [--frametype object]
+"""
+
+from argparse import ArgumentParser
+import json
+import os
+import re
+import sqlite3
+import sys
+
+from pypeit_lev2 import get_config
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS dirs (
+    path TEXT PRIMARY KEY,
+    instrument TEXT,
+    utdate TEXT,
+    signature TEXT
+);
+CREATE TABLE IF NOT EXISTS frames (
+    path TEXT PRIMARY KEY,
+    dir TEXT,
+    instrument TEXT,
+    utdate TEXT,
+    size INTEGER,
+    mtime REAL,
+    frametype TEXT,
+    exptime REAL
+);
+CREATE INDEX IF NOT EXISTS frames_night ON frames (instrument, utdate);
+CREATE INDEX IF NOT EXISTS frames_dir ON frames (dir);
+CREATE TABLE IF NOT EXISTS frame_keys (
+    path TEXT,
+    key TEXT,
+    value TEXT,
+    PRIMARY KEY (path, key)
+);
+CREATE INDEX IF NOT EXISTS frame_keys_value ON frame_keys (key, value);
+'''
+
+
+###
+##### Index Stuff
+###
+
+
+def connect(cfg):
+    """Opens the index database named in the config, creating it if needed
+
+    Returns None if the config has no index.
+    """
+
+    if not cfg.has_section('INDEX') or not cfg['INDEX'].get('db'):
+        return None
+
+    conn = sqlite3.connect(cfg['INDEX']['db'])
+    conn.executescript(SCHEMA)
+
+    return conn
+
+
+def read_header(path, cfg, inst):
+    """Returns the frame type, exposure time and configuration keys of a
+    lev0 file
+    """
+
+    from astropy.io import fits
+
+    header = fits.getheader(path)
+
+    frametype = None
+    for key in cfg['INDEX']['frametype_keys'].split():
+        if key in header:
+            frametype = str(header[key]).strip()
+            break
+
+    exptime = None
+    for key in cfg['INDEX']['exptime_keys'].split():
+        if key in header:
+            try:
+                exptime = float(header[key])
+            except (TypeError, ValueError):
+                continue
+            break
+
+    keys = {}
+    for key in cfg['INDEX'].get(f'config_keys_{inst}', '').split():
+        if key in header:
+            keys[key] = str(header[key]).strip()
+
+    return frametype, exptime, keys
+
+
+def index_dir(conn, cfg, inst, path, utdate=None, full=False, root=None):
+    """Brings the index up to date for a single lev0 directory
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+        Should be from connect()
+    cfg : ConfigParser
+        Should be from get_config()
+    inst : str
+        Instrument name, e.g. DEIMOS
+    path : str
+        lev0 directory
+    utdate : str, optional
+        UT date of the directory, taken from the path if not given
+    full : bool
+        Re-read every file even if it is unchanged
+    root : str, optional
+        File root, e.g. DE., defaults to the one in the config
+
+    Returns
+    -------
+    int
+        Number of headers read
+    """
+
+    # Symlinked trees share the same rows
+    path = os.path.realpath(path)
+    if utdate is None:
+        match = re.search(r'(?:^|/)(\d{8})(?:/|$)', path)
+        utdate = match.group(1) if match else None
+
+    if not os.path.isdir(path):
+        # Directory is gone, so are its frames
+        with conn:
+            remove_frames(conn, conn.execute(
+                'SELECT path FROM frames WHERE dir = ?', (path,)))
+            conn.execute('DELETE FROM dirs WHERE path = ?', (path,))
+        return 0
+
+    if root is None:
+        root = cfg.inst_opts[inst]['root']
+
+    # Frames indexed with another root or other header keys are stale
+    signature = json.dumps([
+        root,
+        cfg['INDEX']['frametype_keys'],
+        cfg['INDEX']['exptime_keys'],
+        cfg['INDEX'].get(f'config_keys_{inst}', '')
+    ])
+    row = conn.execute('SELECT signature FROM dirs WHERE path = ?',
+                       (path,)).fetchone()
+    if row is None or row[0] != signature:
+        full = True
+
+    known = {p: (size, mtime) for p, size, mtime in conn.execute(
+        'SELECT path, size, mtime FROM frames WHERE dir = ?', (path,))}
+
+    read = 0
+    seen = set()
+    with conn:
+        for entry in os.scandir(path):
+            # Same files as from_file_root(..., extension='.fits')
+            if not entry.name.startswith(root) \
+                    or not entry.name.endswith('.fits'):
+                continue
+            if not entry.is_file():
+                continue
+            seen.add(entry.path)
+
+            stat = entry.stat()
+            if known.get(entry.path) == (stat.st_size, stat.st_mtime) \
+                    and not full:
+                continue
+
+            try:
+                frametype, exptime, keys = read_header(entry.path, cfg, inst)
+            except Exception as e:
+                # Still indexed, so PypeIt gets the same files as without
+                # the index. It is read again once its size or mtime change.
+                print(f"Could not read header of {entry.path}: {e}")
+                frametype, exptime, keys = None, None, {}
+            read += 1
+
+            conn.execute('INSERT OR REPLACE INTO frames VALUES '
+                         '(?, ?, ?, ?, ?, ?, ?, ?)',
+                         (entry.path, path, inst, utdate, stat.st_size,
+                          stat.st_mtime, frametype, exptime))
+            conn.execute('DELETE FROM frame_keys WHERE path = ?',
+                         (entry.path,))
+            conn.executemany('INSERT INTO frame_keys VALUES (?, ?, ?)',
+                             [(entry.path, k, v) for k, v in keys.items()])
+
+        remove_frames(conn, [(p,) for p in known if p not in seen])
+        conn.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?, ?, ?)',
+                     (path, inst, utdate, signature))
+
+    return read
+
+
+def remove_frames(conn, paths):
+    paths = list(paths)
+    conn.executemany('DELETE FROM frames WHERE path = ?', paths)
+    conn.executemany('DELETE FROM frame_keys WHERE path = ?', paths)
+
+
+def scan(conn, cfg, inst, start=None, end=None, full=False, root=None,
+         template=None):
+    """Updates the index for every night of an instrument
+
+    Parameters
+    ----------
+    start, end : str, optional
+        Only scan nights in this UT date range (yyyymmdd)
+    root : str, optional
+        File root, e.g. DE., defaults to the one in the config
+    template : str, optional
+        lev0 directory with INSTRUMENT and UTDATE, defaults to the one in
+        the config
+
+    Returns
+    -------
+    int
+        Number of headers read
+    """
+
+    if template is None:
+        template = cfg['INDEX']['lev0_dir']
+    template = template.replace('INSTRUMENT', inst)
+    parent = os.path.dirname(template.split('UTDATE')[0] + 'x')
+
+    try:
+        utdates = sorted(d for d in os.listdir(parent)
+                         if re.fullmatch(r'\d{8}', d))
+    except OSError as e:
+        print(f"Could not list {parent}: {e}")
+        return 0
+
+    # Forget nights that are no longer on disk
+    for path, utdate in conn.execute(
+            'SELECT path, utdate FROM dirs WHERE instrument = ?',
+            (inst,)).fetchall():
+        if utdate not in utdates:
+            index_dir(conn, cfg, inst, path, utdate, root=root)
+
+    read = 0
+    for utdate in utdates:
+        if (start and utdate < start) or (end and utdate > end):
+            continue
+        path = template.replace('UTDATE', utdate)
+        if not os.path.isdir(path):
+            continue
+        read += index_dir(conn, cfg, inst, path, utdate, full, root)
+
+    return read
+
+
+def key_filter(keys):
+    """Returns the SQL clause and parameters selecting frames that match
+    all of the given configuration keys
+    """
+
+    sql = ''
+    params = []
+    for key, value in keys.items():
+        sql += (' AND path IN (SELECT path FROM frame_keys'
+                ' WHERE key = ? AND value = ?)')
+        params += [key, value]
+
+    return sql, params
+
+
+def find_frames(conn, inst=None, utdate=None, dir=None, frametype=None,
+                keys={}):
+    """Returns the indexed frames matching the arguments, sorted by path
+    """
+
+    sql = 'SELECT path FROM frames WHERE 1'
+    params = []
+    for column, value in (('instrument', inst), ('utdate', utdate),
+                          ('dir', dir), ('frametype', frametype)):
+        if value is not None:
+            sql += f' AND {column} = ?'
+            params.append(value)
+    key_sql, key_params = key_filter(keys)
+
+    rows = conn.execute(sql + key_sql + ' ORDER BY path', params + key_params)
+
+    return [row[0] for row in rows]
+
+
+def find_nights(conn, inst, start=None, end=None, frametype=None, keys={}):
+    """Returns (utdate, number of frames) for each night of an instrument
+    with matching frames, largest nights first
+    """
+
+    sql = 'SELECT utdate, COUNT(*) FROM frames WHERE instrument = ?'
+    params = [inst]
+    if start:
+        sql += ' AND utdate >= ?'
+        params.append(start)
+    if end:
+        sql += ' AND utdate <= ?'
+        params.append(end)
+    if frametype:
+        sql += ' AND frametype = ?'
+        params.append(frametype)
+    key_sql, key_params = key_filter(keys)
+    sql += key_sql + ' GROUP BY utdate ORDER BY COUNT(*) DESC, utdate'
+
+    return conn.execute(sql, params + key_params).fetchall()
+
+
+def parse_keys(pairs):
+    """Turns KEY=VALUE strings into a dict
+    """
+
+    keys = {}
+    for pair in pairs or []:
+        key, _, value = pair.partition('=')
+        keys[key.upper()] = value
+
+    return keys
+
+
+###
+##### Script Stuff
+###
+
+
+def get_parsed_args():
+    """Returns the parsed command line arguments
+
+    Returns
+    -------
+    argparse NameSpace
+        contains all of the parsed arguments
+    """
+
+    parser = ArgumentParser()
+
+    parser.add_argument('command', choices=['scan', 'nights', 'frames'],
+                        help='scan, nights, frames')
+
+    parser.add_argument('inst', help='Instrument choice')
+
+    parser.add_argument('utdate', nargs='?',
+                        help='UT date for the frames command (yyyymmdd)')
+
+    parser.add_argument('-s', '--start', dest='start',
+                        help='First UT date of the range (yyyymmdd)')
+
+    parser.add_argument('-e', '--end', dest='end',
+                        help='Last UT date of the range (yyyymmdd)')
+
+    parser.add_argument('-c', '--config', dest='cfg_file',
+                        default='./pypeit_lev2.live.ini', help='Config file to use')
+
+    parser.add_argument('--full', dest='full', action='store_true',
+                        help='Re-read every header, even if unchanged')
+
+    parser.add_argument('--frametype', dest='frametype',
+                        help='Only frames of this type, e.g. object')
+
+    parser.add_argument('--key', dest='keys', action='append',
+                        help='Only frames with this KEY=VALUE, repeatable')
+
+    pargs = parser.parse_args()
+
+    return pargs
+
+
+def main():
+
+    pargs = get_parsed_args()
+    cfg = get_config(pargs.cfg_file)
+
+    if pargs.inst not in cfg.inst_opts.keys():
+        print(f"Invalid instrument name {pargs.inst}")
+        sys.exit(1)
+
+    conn = connect(cfg)
+    if conn is None:
+        print("No [INDEX] db in the config")
+        sys.exit(1)
+
+    keys = parse_keys(pargs.keys)
+
+    if pargs.command == 'scan':
+        read = scan(conn, cfg, pargs.inst, pargs.start, pargs.end, pargs.full)
+        print(f"Read {read} headers")
+    elif pargs.command == 'nights':
+        for utdate, count in find_nights(conn, pargs.inst, pargs.start,
+                                         pargs.end, pargs.frametype, keys):
+            print(f"{utdate} {count}")
+    elif pargs.command == 'frames':
+        for path in find_frames(conn, pargs.inst, pargs.utdate,
+                                frametype=pargs.frametype, keys=keys):
+            print(path)
+
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,393 @@
+"""Reprocess a range of UT dates for one or more instruments.
+
+Every night in the range is set up and all of its configurations are put on
+one global queue, so the pool never idles waiting for a single night to
+finish.  The queue can be paused and throttled while running:
+
+    touch <state_dir>/PAUSE           stop launching new jobs
+    echo 4 > <state_dir>/THROTTLE     run at most 4 jobs at once
+
+Completed jobs are recorded in <state_dir>/state.json and the queue progress
+in <state_dir>/status.json.  Running the same command again resumes where the
+last run stopped; delete the state file to start over.  Reductions are
+recorded per mode, so a --calibonly pass does not skip a later full run.
+
+Example use:
+python pypeit_backlog.py DEIMOS MOSFIRE -s 20240201 -e 20240731 -n 60
+python pypeit_backlog.py DEIMOS -s 20240201 -e 20240731 --key GRATENAM=900ZD
+"""
+
+from argparse import ArgumentParser, Namespace
+from collections import deque
+from datetime import datetime, timedelta
+from multiprocessing import Pool
+import json
+import os
+import sys
+import time
+
+import lev0_index
+from pypeit_lev2 import (get_config, generate_pypeit_files, find_pypeit_files,
+                         add_pypeit_pars, run_pypeit_helper)
+
+
+###
+##### Queue Stuff
+###
+
+
+def setup_night(pargs, cfg):
+    """Creates the .pypeit files for a single night, run in a pool worker
+
+    Parameters
+    ----------
+    pargs : Namespace
+        Night arguments, from get_nights()
+    cfg : ConfigParser
+        Should be from get_config()
+
+    Returns
+    -------
+    list of str
+        .pypeit files for each configuration of the night
+    """
+
+    from pypeit.pypeitsetup import PypeItSetup
+
+    generate_pypeit_files(pargs, PypeItSetup, cfg)
+    pypeit_files = find_pypeit_files(pargs)
+    add_pypeit_pars(pypeit_files)
+
+    return [str(f) for f in pypeit_files]
+
+
+def get_nights(pargs, cfg):
+    """Returns the arguments for every night in the range that has raw data
+
+    Nights are taken from the lev0 index when one is configured, which also
+    allows selecting them by frame type and configuration keys.
+
+    Parameters
+    ----------
+    pargs : Parsed command line arguments
+        Should be from get_parsed_args()
+    cfg : ConfigParser
+        Should be from get_config()
+
+    Returns
+    -------
+    list of Namespace
+        One entry per instrument and night, as pypeit_lev2 expects them
+    """
+
+    conn = lev0_index.connect(cfg)
+    keys = lev0_index.parse_keys(pargs.keys)
+    if conn is None and (keys or pargs.frametype):
+        print("Selecting nights by --key or --frametype needs the lev0 index")
+        sys.exit(1)
+
+    # One lev0 template for choosing and reducing nights, so both use the
+    # same tree
+    input_dir = cfg['BACKLOG'].get('input_dir') or cfg['INDEX']['lev0_dir']
+
+    nights = []
+    for inst in pargs.insts:
+        output_dir = cfg['BACKLOG'].get(f'output_dir_{inst}',
+                                        cfg['BACKLOG']['output_dir'])
+
+        # (utdate, number of frames) for every night worth trying
+        if conn is not None:
+            lev0_index.scan(conn, cfg, inst, pargs.start, pargs.end,
+                            template=input_dir)
+            utdates = lev0_index.find_nights(conn, inst, pargs.start,
+                                             pargs.end, pargs.frametype, keys)
+        else:
+            utdates = []
+            day = datetime.strptime(pargs.start, '%Y%m%d')
+            while day <= datetime.strptime(pargs.end, '%Y%m%d'):
+                utdates.append((day.strftime('%Y%m%d'), 0))
+                day += timedelta(days=1)
+
+        for utdate, count in utdates:
+            night = Namespace(
+                inst=inst,
+                utdate=utdate,
+                input=input_dir.replace('INSTRUMENT', inst)
+                               .replace('UTDATE', utdate),
+                output=output_dir.replace('INSTRUMENT', inst)
+                                 .replace('UTDATE', utdate),
+                root=cfg.inst_opts[inst]['root'],
+                pypeit_name=cfg.inst_opts[inst]['pypeit_name'],
+                calib=pargs.calib,
+                setup=pargs.setup,
+                frames=count
+            )
+            if not os.path.isdir(night.input):
+                continue
+            nights.append(night)
+
+    if conn is not None:
+        conn.close()
+
+    # Largest nights first, so the long reductions don't finish the queue
+    nights.sort(key=lambda night: night.frames, reverse=True)
+
+    return nights
+
+
+def get_limit(state_dir, num):
+    """Returns how many jobs may run right now, from the PAUSE and THROTTLE
+    files in the state directory
+    """
+
+    if os.path.exists(os.path.join(state_dir, 'PAUSE')):
+        return 0
+
+    throttle = os.path.join(state_dir, 'THROTTLE')
+    try:
+        with open(throttle) as f:
+            return max(0, min(num, int(f.read().strip())))
+    except (OSError, ValueError):
+        return num
+
+
+def load_state(state_file):
+    try:
+        with open(state_file) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_state(state_file, state):
+    tmp = state_file + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    os.replace(tmp, state_file)
+
+
+def save_status(state_dir, pending, running, state, paused, last_exit_code):
+    """Writes <state_dir>/status.json, read by the drp_status.py service
+    """
+
+    statuses = list(state.values())
+    status = {
+        'updated': datetime.utcnow().isoformat(),
+        'paused': paused,
+        'queue_depth': pending,
+        'running': sorted(running),
+        'done': statuses.count('done'),
+        'failed': statuses.count('failed'),
+        'last_exit_code': last_exit_code
+    }
+    save_state(os.path.join(state_dir, 'status.json'), status)
+
+
+def run_backlog(nights, pargs, cfg):
+    """Runs every setup and reduction job on one pool
+
+    Setup jobs go first so that their configurations join the queue while
+    earlier reductions are still running.
+
+    Parameters
+    ----------
+    nights : list of Namespace
+        Should be from get_nights()
+    pargs : Parsed command line arguments
+        Should be from get_parsed_args()
+    cfg : ConfigParser
+        Should be from get_config()
+
+    Returns
+    -------
+    dict
+        Job key to 'done' or 'failed'
+    """
+
+    state_dir = pargs.state_dir
+    os.makedirs(state_dir, exist_ok=True)
+    state_file = os.path.join(state_dir, 'state.json')
+    state = load_state(state_file)
+    poll = cfg['BACKLOG'].getfloat('poll', 5)
+
+    # Each job is (key, function, args)
+    pending = deque()
+    reductions = []
+    for night in nights:
+        key = f'{night.inst}/{night.utdate}'
+        if state.get(key) == 'done':
+            reductions += get_reductions(night, find_pypeit_files(night),
+                                         state, cfg)
+        else:
+            pending.append((key, setup_night, (night, cfg)))
+    pending.extend(reductions)
+
+    total = len(pending)
+    finished = 0
+    print(f"Queued {total} jobs from {len(nights)} nights")
+
+    with Pool(processes=pargs.num_proc) as pool:
+        running = {}
+        paused = False
+        last_exit_code = None
+        while pending or running:
+
+            limit = get_limit(state_dir, pargs.num_proc)
+            if limit == 0 and not paused:
+                print("Queue paused")
+            elif limit > 0 and paused:
+                print("Queue resumed")
+            paused = limit == 0
+
+            while pending and len(running) < limit:
+                key, func, args = pending.popleft()
+                running[key] = (func, args, pool.apply_async(func, args))
+
+            save_status(state_dir, len(pending), running.keys(), state,
+                        paused, last_exit_code)
+            time.sleep(poll)
+
+            for key, (func, args, res) in list(running.items()):
+                if not res.ready():
+                    continue
+                del running[key]
+                finished += 1
+
+                try:
+                    result = res.get()
+                except Exception as e:
+                    print(f"Error encountered in {key}: {e}")
+                    state[key] = 'failed'
+                    save_state(state_file, state)
+                    continue
+
+                if func is setup_night:
+                    new = get_reductions(args[0], result, state, cfg)
+                    pending.extend(new)
+                    total += len(new)
+                    state[key] = 'done'
+                else:
+                    state[key] = 'done' if result == 0 else 'failed'
+                    last_exit_code = result
+                save_state(state_file, state)
+
+                print(f"[{finished}/{total}] {key} {state[key]}, "
+                      f"{len(running)} running, {len(pending)} pending")
+
+        save_status(state_dir, 0, [], state, paused, last_exit_code)
+
+    return state
+
+
+def get_reductions(night, pypeit_files, state, cfg):
+    """Returns the reduction jobs of a night that have not completed yet in
+    the requested mode
+    """
+
+    jobs = []
+    if night.setup:
+        return jobs
+
+    mode = 'calibonly' if night.calib else 'full'
+    for pypeit_file in pypeit_files:
+        name = os.path.basename(pypeit_file)
+        key = f'{night.inst}/{night.utdate}/{mode}/{name}'
+        if state.get(key) == 'done':
+            continue
+        jobs.append((key, run_pypeit_helper, (pypeit_file, night, cfg)))
+
+    return jobs
+
+
+###
+##### Script Stuff
+###
+
+
+def get_parsed_args():
+    """Returns the parsed command line arguments
+
+    Returns
+    -------
+    argparse NameSpace
+        contains all of the parsed arguments
+    """
+
+    parser = ArgumentParser()
+
+    parser.add_argument('insts', nargs='+',
+                        help='Instruments to reprocess, e.g. DEIMOS MOSFIRE')
+
+    parser.add_argument('-s', '--start', dest='start', required=True,
+                        help='First UT date of the range (yyyymmdd)')
+
+    parser.add_argument('-e', '--end', dest='end', required=True,
+                        help='Last UT date of the range (yyyymmdd)')
+
+    parser.add_argument('-n', '--num-proc', dest='num_proc', type=int,
+                        help='number of processes to launch')
+
+    parser.add_argument('-c', '--config', dest='cfg_file',
+                        default='./pypeit_lev2.live.ini', help='Config file to use')
+
+    parser.add_argument('--state-dir', dest='state_dir',
+                        help='Directory for the queue state, PAUSE and ' +
+                        'THROTTLE files. Defaults to the config value')
+
+    parser.add_argument('--frametype', dest='frametype',
+                        help='Only nights with frames of this type, ' +
+                        'e.g. object. Needs the lev0 index')
+
+    parser.add_argument('--key', dest='keys', action='append',
+                        help='Only nights with frames having this KEY=VALUE, ' +
+                        'repeatable. Needs the lev0 index')
+
+    parser.add_argument('--setup-only', dest='setup', action='store_true',
+                        help="Only create the pypeit files, don't reduce them")
+
+    parser.add_argument('--calibonly', dest='calib', action='store_true',
+                        help='process calibrations only')
+
+    pargs = parser.parse_args()
+
+    return pargs
+
+
+def main():
+
+    # Parse the arguments
+    pargs = get_parsed_args()
+
+    # Get configuration
+    cfg = get_config(pargs.cfg_file)
+
+    for inst in pargs.insts:
+        if inst not in cfg.inst_opts.keys():
+            print(f"Invalid instrument name {inst}")
+            sys.exit(1)
+
+    for date in (pargs.start, pargs.end):
+        try:
+            datetime.strptime(date, '%Y%m%d')
+        except ValueError:
+            print(f"Not a valid date: '{date}'")
+            sys.exit(1)
+
+    if pargs.state_dir is None:
+        pargs.state_dir = cfg['BACKLOG']['state_dir']
+    if pargs.num_proc is None:
+        pargs.num_proc = os.cpu_count() - 1
+
+    nights = get_nights(pargs, cfg)
+    print(f"Found {len(nights)} nights between {pargs.start} and {pargs.end}")
+
+    state = run_backlog(nights, pargs, cfg)
+
+    failed = [key for key, status in state.items() if status == 'failed']
+    for key in sorted(failed):
+        print(f"    failed: {key}")
+    print(f"Backlog complete! {len(failed)} failed jobs")
+
+
+if __name__ == '__main__':
+    main()
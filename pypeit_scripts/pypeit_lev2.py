@@ -1,9 +1,12 @@
-from copy import copy
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import partial
 from pathlib import Path
+import gzip
+import hashlib
 import os
+import shutil
 import sys
-import requests
 from multiprocessing import Pool
 from argparse import ArgumentParser
 from configparser import ConfigParser
@@ -37,9 +40,14 @@ def generate_pypeit_files(pargs, setup, cfg):
     print(f'Looking for files matching {root}*.fits*')
     print(f'Outputs will be saved in {setup_dir}')
 
-    # Create the setup object
-    ps = setup.from_file_root(root, pargs.pypeit_name,
-                                    extension=".fits")
+    # Create the setup object, from the lev0 index if there is one
+    files = find_input_files(pargs, cfg)
+    if not files:
+        ps = setup.from_file_root(root, pargs.pypeit_name,
+                                        extension=".fits")
+    else:
+        print(f'Found {len(files)} files in the lev0 index')
+        ps = setup.from_rawfiles(files, pargs.pypeit_name)
     ps.user_cfg = ['[rdx]', 'ignore_bad_headers = True']
     if "deimos" in pargs.inst and deimos_det_5_is_bad:
         ps.user_cfg += [f'detnum = {deimos_detnum}']
@@ -63,9 +71,61 @@ def generate_pypeit_files(pargs, setup, cfg):
                                            version_override=None,
                                            date_override=None)
 
+def find_input_files(pargs, cfg):
+    """Returns the raw files of pargs.input from the lev0 index, after
+    bringing the index up to date for that directory
+
+    Returns None if no index is configured or it can't be used, so the
+    caller can fall back to searching the directory itself.
+    """
+
+    import sqlite3
+    import lev0_index
+
+    try:
+        conn = lev0_index.connect(cfg)
+        if conn is None:
+            return None
+
+        try:
+            lev0_index.index_dir(conn, cfg, pargs.inst, pargs.input,
+                                 root=pargs.root)
+            files = lev0_index.find_frames(conn,
+                                           dir=os.path.realpath(pargs.input))
+        finally:
+            conn.close()
+    except (sqlite3.Error, OSError) as e:
+        print(f"Could not use the lev0 index, searching the directory: {e}")
+        return None
+
+    return files
+
 def run_pypeit_helper(pypeit_file, pargs, cfg):
     """Runs a PypeIt reduction off of a specific .pypeit file, using the io
-    parameters in pargs.
+    parameters in pargs, then packages the products and alerts RTI.
+
+    Parameters
+    ----------
+    pypeit_file : str or pathlike
+        .pypeit file to reduce
+    pargs : Parsed command line arguments
+        Should be from get_parsed_args()
+
+    Returns
+    -------
+    int
+        Return code of run_pypeit
+    """
+
+    outputs, returncode = reduce_config(pypeit_file, pargs)
+    finish_config(outputs, returncode, pargs, cfg)
+
+    return returncode
+
+
+def reduce_config(pypeit_file, pargs):
+    """Runs run_pypeit on a specific .pypeit file, using the io parameters
+    in pargs.
 
     The reduction is launched in a subprocess using the subprocess library, with
     stdout and stderr directed to a single log file. 
@@ -76,6 +136,11 @@ def run_pypeit_helper(pypeit_file, pargs, cfg):
         .pypeit file to reduce
     pargs : Parsed command line arguments
         Should be from get_parsed_args()
+
+    Returns
+    -------
+    tuple
+        Output directory of the reduction and return code of run_pypeit
     """
 
     print(f"Processing config from {str(pypeit_file)}")
@@ -101,15 +166,190 @@ def run_pypeit_helper(pypeit_file, pargs, cfg):
 
     if proc.returncode != 0:
         print(f"Error encountered while reducing {pypeit_file}")
-        print("Attempting to alert RTI anyway...")
     else:
         print(f"Reduced {pypeit_file}")
-        print("Alerting RTI...")
-    
-    alert_RTI(outputs, pargs, cfg)
     print(f"Log can be found at {logpath}")
     f.close()
 
+    return outputs, proc.returncode
+
+
+def finish_config(outputs, returncode, pargs, cfg):
+    """Packages the products of a reduction, if configured, and alerts RTI
+
+    Parameters
+    ----------
+    outputs : str or pathlike
+        Output directory of the reduction, from reduce_config()
+    returncode : int
+        Return code of run_pypeit
+    pargs : Parsed command line arguments
+        Should be from get_parsed_args()
+    cfg : ConfigParser
+        Should be from get_config()
+    """
+
+    if returncode != 0:
+        print(f"Reduction of {outputs} failed, attempting to alert RTI anyway...")
+
+    # RTI is alerted even if packaging fails, as it is for failed reductions
+    try:
+        package_products(outputs, cfg)
+    except Exception as e:
+        print(f"Error encountered while packaging {outputs}: {e}")
+
+    print("Alerting RTI...")
+    alert_RTI(outputs, pargs, cfg)
+
+
+def find_pypeit_files(pargs):
+    """Returns the .pypeit files written by generate_pypeit_files()
+
+    Parameters
+    ----------
+    pargs : Parsed command line arguments
+        Should be from get_parsed_args()
+
+    Returns
+    -------
+    list of Path
+        Only the pypeit files that are for an instrument configuration
+    """
+
+    setup_files = Path(pargs.output) / 'pypeit_files'
+    return list(setup_files.rglob(f'{pargs.pypeit_name}_?.pypeit'))
+
+
+def add_pypeit_pars(pypeit_files):
+    """Adds our special parameters to the user parameter block of each
+    .pypeit file, in place
+
+    Parameters
+    ----------
+    pypeit_files : list of str or pathlike
+        .pypeit files to update
+    """
+
+    # For each pypeit file
+        # Open it
+        # Advance to user parameters
+        # Add in whatever we require
+        # Close and save
+
+    pars = "[calibrations]\n[[flatfield]]\nsaturated_slits = mask\n"
+
+    for file in pypeit_files:
+        with open(file, 'r+') as f:
+            contents = f.readlines()
+            for index, line in enumerate(contents):
+                if "# Setup" in line:
+                    contents.insert(index - 1, pars)
+                    break
+            f.seek(0)
+            f.writelines(contents)
+
+
+###
+##### Packaging Stuff
+###
+
+
+def package_products(outputs, cfg):
+    """Compresses the FITS products of a reduction and writes a checksum
+    manifest, as set in the [PACKAGE] section of the config.
+
+    Files are handled in a thread pool; gzip and sha256 release the GIL, and
+    fpack runs in its own process.
+
+    Parameters
+    ----------
+    outputs : str or pathlike
+        Output directory of the reduction
+    cfg : ConfigParser
+        Should be from get_config()
+
+    Returns
+    -------
+    list of Path
+        The packaged products, empty if packaging is off
+    """
+
+    if not cfg.has_section('PACKAGE'):
+        return []
+
+    compression = cfg['PACKAGE'].get('compression', 'none')
+    manifest = cfg['PACKAGE'].getboolean('manifest', False)
+    workers = cfg['PACKAGE'].getint('workers', 4)
+    if compression not in ('none', 'gzip', 'fpack'):
+        print(f"Unknown compression '{compression}' in [PACKAGE], should be "
+              "none, gzip or fpack. Not compressing")
+        compression = 'none'
+    if compression == 'none' and not manifest:
+        return []
+
+    outputs = Path(outputs)
+    products = sorted(outputs.rglob('*.fits'))
+    print(f"Packaging {len(products)} products in {outputs} ({compression})")
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        products = list(executor.map(
+            lambda path: compress_product(path, compression, cfg), products))
+
+        # Include products compressed by an earlier run
+        products += [p for p in outputs.rglob('*.fits.*')
+                     if p.suffix in ('.gz', '.fz') and p not in products]
+        products.sort()
+
+        if manifest:
+            sums = executor.map(sha256sum, products)
+            manifest_path = outputs / 'MANIFEST.sha256'
+            with open(manifest_path, 'w') as f:
+                for path, digest in zip(products, sums):
+                    f.write(f"{digest}  {path.relative_to(outputs)}\n")
+            print(f"Wrote {manifest_path}")
+
+    return products
+
+
+def compress_product(path, compression, cfg):
+    """Compresses a single FITS file, replacing it. Returns the new path.
+    """
+
+    try:
+        if compression == 'gzip':
+            level = cfg['PACKAGE'].getint('gzip_level', 6)
+            new_path = path.with_name(path.name + '.gz')
+            with open(path, 'rb') as f_in, \
+                    gzip.open(new_path, 'wb', compresslevel=level) as f_out:
+                shutil.copyfileobj(f_in, f_out, 1024 * 1024)
+            path.unlink()
+            return new_path
+
+        if compression == 'fpack':
+            # -D deletes the input, -Y skips the confirmation
+            proc = subprocess.run(['fpack', '-D', '-Y', str(path)],
+                                  capture_output=True, text=True)
+            if proc.returncode != 0:
+                print(f"fpack failed on {path}: {proc.stderr.strip()}")
+                return path
+            return path.with_name(path.name + '.fz')
+
+    except OSError as e:
+        print(f"Could not compress {path}: {e}")
+        if compression == 'gzip' and path.exists():
+            # Don't leave a truncated .gz for the next run to pick up
+            new_path.unlink(missing_ok=True)
+
+    return path
+
+
+def sha256sum(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
 
 ###
 ##### RTI Stuff
@@ -118,6 +358,8 @@ def run_pypeit_helper(pypeit_file, pargs, cfg):
 
 def alert_RTI(directory, pargs, cfg):
 
+    import requests
+
     def get_url(url, data):
         try:
             res = requests.get(url,
@@ -231,14 +473,6 @@ def print_inst_options(cfg):
 
 def main():
 
-    try:
-        from pypeit.pypeitsetup import PypeItSetup
-    except ImportError:
-        print("Could not import PypeIt. Is it installed in this environment?")
-        print("Exiting...")
-        sys.exit(1)
-
-    
     # Parse the arguments
     pargs = get_parsed_args()
     
@@ -262,50 +496,52 @@ def main():
     if pargs.root is None:
         pargs.root = cfg.inst_opts[pargs.inst]['root']
 
+    # PypeIt is slow to import, only do it once we know there is work
+    try:
+        from pypeit.pypeitsetup import PypeItSetup
+    except ImportError:
+        print("Could not import PypeIt. Is it installed in this environment?")
+        print("Exiting...")
+        sys.exit(1)
 
     # Create all the pypeit files
     generate_pypeit_files(pargs, PypeItSetup, cfg)
     
-    setup_files = Path(pargs.output) / 'pypeit_files'
-    # Select only the pypeit files that are for an instrument configuration
-    pypeit_files = list(setup_files.rglob(f'{pargs.pypeit_name}_?.pypeit'))
-    
-    # Add in special parameters
-    # For each pypeit file
-        # Open it
-        # Advance to user parameters
-        # Add in whatever we require
-        # Close and save
-    
-    pars = "[calibrations]\n[[flatfield]]\nsaturated_slits = mask\n"
-    
-    for file in pypeit_files:
-        with open(file, 'r+') as f:
-            contents = f.readlines()
-            for index, line in enumerate(contents):
-                if "# Setup" in line:
-                    contents.insert(index - 1, pars)
-                    break
-            f.seek(0)
-            f.writelines(contents)
+    pypeit_files = find_pypeit_files(pargs)
+    add_pypeit_pars(pypeit_files)
             
-    args = []
-
-    # Create the arguments for the pool mapping function
     print("Found the following .pypeit files:")
     for f in pypeit_files:
         print(f'    {f}')
-        new_pargs = copy(pargs)
-        # new_pargs.output = os.path.join(pargs.output)
-        print(f"          Output is {new_pargs.output}")
-        args.append((f, new_pargs, cfg))
+        print(f"          Output is {pargs.output}")
 
     if not pargs.setup:
         num = pargs.num_proc if pargs.num_proc else os.cpu_count() - 1
         print(f"Launching {num} procs to reduce {len(pypeit_files)} configs")
 
-        with Pool(processes=num) as pool:
-            pool.starmap(func=run_pypeit_helper, iterable=args)
+        # Progress for drp_status.py, in the same status.json as the backlog
+        from pypeit_backlog import save_status
+        state = {}
+        last_exit_code = None
+        save_status(pargs.output, len(pypeit_files), [], state, False,
+                    last_exit_code)
+
+        # Package and alert in threads as each reduction finishes, so the
+        # pool moves straight on to the next configuration
+        with ThreadPoolExecutor() as finisher:
+            with Pool(processes=num) as pool:
+                finishing = []
+                for outputs, returncode in pool.imap_unordered(
+                        partial(reduce_config, pargs=pargs), pypeit_files):
+                    finishing.append(finisher.submit(
+                        finish_config, outputs, returncode, pargs, cfg))
+
+                    state[outputs] = 'done' if returncode == 0 else 'failed'
+                    last_exit_code = returncode
+                    save_status(pargs.output, len(pypeit_files) - len(state),
+                                [], state, False, last_exit_code)
+            for future in finishing:
+                future.result()
     
         print("Reduction complete!")
 